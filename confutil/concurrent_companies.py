@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Configure independent companies concurrently, each in its own transaction.
+
+    def configure(cr, registry, uid, company, context):
+        setup_company_accounts(cr, registry, uid, company, chart_template, context=context)
+        Config(cr, registry, uid, context=context).set_default_customer_sale_pricelist(company, pricelist)
+
+    configure_companies(registry, company_ids, configure, workers=4)
+
+The workers have their own connections, so they only see what the calling
+transaction has committed, and they may need rows it has locked.  PostgreSQL
+can't see that the caller is waiting for them in Python, so it would never
+detect that deadlock.  Call this when the calling transaction has nothing
+outstanding: in a post_init_hook that means calling cr.commit() first, which
+makes everything installed so far permanent even if the installation fails
+later on.  As a safety net each worker transaction has a lock_timeout.
+
+Pass the registry you were given rather than fetching it by database name:
+while modules are being installed Odoo holds the registry lock, and a worker
+calling openerp.registry() would wait for it forever.
+
+Each company is configured by a worker thread with its own cursor, and
+committed separately.  Settings forms called through confutil take
+PostgreSQL advisory locks while that is happening:
+
+    * one per (settings model, company) for company-specific settings
+    * one global lock for settings without a company
+
+There is only one global lock and each transaction works on one company,
+so two transactions can never each hold a lock the other is waiting for.
+
+Settings with module_* fields are refused in this mode: installing or
+uninstalling modules commits the transaction and rebuilds the registry, which
+would release the locks and make rolling back a failed company impossible.
+Apply those first, in the ordinary sequential part of your hook.
+"""
+
+import hashlib
+import struct
+import sys
+import threading
+import traceback
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+# Context key telling set_settings to take advisory locks
+LOCKS_CONTEXT_KEY = 'confutil_advisory_locks'
+
+GLOBAL_RESOURCE = ('confutil', 'global')
+
+
+class ConcurrentConfigurationError(Exception):
+    """Raised when configuring some of the companies failed.
+
+    failures: Dictionary mapping company id to the formatted traceback
+    configured: List of ids of the companies that were configured and committed
+    """
+    def __init__(self, failures, configured):
+        self.failures = failures
+        self.configured = configured
+        Exception.__init__(self, 'Configuration failed for %d companies:\n%s' % (
+            len(failures),
+            '\n'.join('company %d:\n%s' % (company_id, failures[company_id]) for company_id in sorted(failures)),
+        ))
+
+
+def lock_key(resource):
+    """Return a signed 64-bit advisory lock key for resource, a tuple of strings and ints.
+    """
+    name = u'\x1f'.join(u'%s' % (part,) for part in resource)
+    digest = hashlib.sha1(name.encode('utf-8')).digest()
+    return struct.unpack('>q', digest[:8])[0]
+
+
+def advisory_lock(cr, resources):
+    """Take transaction-level advisory locks on all of resources, always in the same order.
+
+    The locks are released when the transaction commits or rolls back.
+    """
+    for key in sorted(set(lock_key(resource) for resource in resources)):
+        cr.execute('SELECT pg_advisory_xact_lock(%s)', (key,))
+
+
+def settings_resources(settings_model_name, changes, company=None):
+    """Return the resources to lock before executing a settings form.
+
+    Raises ValueError if changes would install or uninstall modules.
+    """
+    modules = sorted(field for field in changes if field.startswith('module_'))
+    if modules:
+        raise ValueError("%s: can't change %s while configuring companies concurrently"
+            % (settings_model_name, ', '.join(modules)))
+    if company is None:
+        return [GLOBAL_RESOURCE]
+    return [('settings', settings_model_name, company.id)]
+
+
+def configure_companies(registry, company_ids, configure, uid=1, context=None, workers=4,
+                        lock_timeout_ms=60000, retries=3):
+    """Call configure for each company concurrently, each in its own transaction.
+
+    registry: Registry of the database, e.g. the one passed to a post_init_hook
+    company_ids: Ids of the companies to configure
+    configure: Function called as configure(cr, registry, uid, company, context)
+    uid: User to configure as, usually openerp.SUPERUSER_ID
+    context: Context to pass to configure.  Settings forms executed through
+             confutil with this context take advisory locks.
+    workers: Number of threads, each with its own database connection
+    lock_timeout_ms: lock_timeout for each company's transaction
+    retries: Number of times to retry a company whose transaction hits a
+             serialization failure or deadlock
+
+    The workers use their own connections, so they can't see anything the
+    calling transaction hasn't committed yet.  Commit it before calling this.
+
+    Each company's transaction is committed as soon as configure returns.
+    A company whose configure raises is rolled back, the others carry on, and
+    ConcurrentConfigurationError is raised at the end listing every failure.
+
+    Return list of ids of the companies configured.
+    """
+    import openerp
+    from psycopg2.extensions import TransactionRollbackError
+
+    context = dict(context or {})
+    context[LOCKS_CONTEXT_KEY] = True
+    pending = list(company_ids)
+    pending.reverse()
+    pending_lock = threading.Lock()
+    done = []
+    failures = {}
+
+    def next_company():
+        with pending_lock:
+            return pending.pop() if pending else None
+
+    def work():
+        with openerp.api.Environment.manage():
+            cr = registry.cursor()
+            try:
+                while True:
+                    company_id = next_company()
+                    if company_id is None:
+                        return
+                    attempt = 0
+                    while True:
+                        attempt += 1
+                        try:
+                            cr.execute('SET LOCAL lock_timeout = %s', (int(lock_timeout_ms),))
+                            company = registry['res.company'].browse(cr, uid, company_id, context=context)
+                            configure(cr, registry, uid, company, dict(context))
+                            cr.commit()
+                            done.append(company_id)
+                            _logger.debug('configure_companies: Configured company %d' % (company_id,))
+                        except TransactionRollbackError:
+                            # Serialization failure or deadlock: another worker got there first
+                            cr.rollback()
+                            if attempt <= retries:
+                                _logger.info('configure_companies: Retrying company %d after %s'
+                                    % (company_id, sys.exc_info()[1]))
+                                continue
+                            failures[company_id] = ''.join(traceback.format_exception(*sys.exc_info()))
+                            _logger.error('configure_companies: Failed to configure company %d' % (company_id,), exc_info=True)
+                        except Exception:
+                            cr.rollback()
+                            failures[company_id] = ''.join(traceback.format_exception(*sys.exc_info()))
+                            _logger.error('configure_companies: Failed to configure company %d' % (company_id,), exc_info=True)
+                        break
+            finally:
+                cr.close()
+
+    threads = [
+        threading.Thread(target=work, name='confutil-company-%d' % (n,))
+        for n in range(min(workers, len(pending)))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if failures:
+        raise ConcurrentConfigurationError(failures, done)
+    return done
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -27,7 +27,12 @@ ones where dependent records don't have external IDs, or changes to Settings ->
 screens need to be made (so execute() has to be called afterwards).
 """
 
+import itertools
 import logging
+
+from . import concurrent_companies
+from . import settings_jobs
+
 _logger = logging.getLogger(__name__)
 
 class Lookup(object):
@@ -40,12 +45,16 @@ class Lookup(object):
     Then you can do things like:
 
         map(lookup.tax_id_by_code, ['UKST1', 'USST1', 'FRST1'])
+
+    Pass a lookup_cache.LookupCache as cache to remember XMLID, field
+    and group ids between runs.
     """
-    def __init__(self, cr, registry, uid, context=None):
+    def __init__(self, cr, registry, uid, context=None, cache=None):
         self._cr = cr
         self._registry = registry
         self._uid = uid
         self._context = context or {}
+        self._cache = cache
 
 
     def tax_id_by_code(self, code):
@@ -97,7 +106,17 @@ class Lookup(object):
             if not isinstance(xmlid, (str, unicode)):
                 raise TypeError('xmlid(module, xmlid) form: xmlid must be a string')
             module, identifier = module_or_dotted_xmlid, xmlid
-        return IMD.get_object(self._cr, self._uid, module, identifier)
+        if self._cache is None:
+            return IMD.get_object(self._cr, self._uid, module, identifier)
+
+        key = 'xmlid:%s.%s' % (module, identifier)
+        cached = self._cache.get(key)
+        if cached is not None:
+            model_name, res_id = cached.split(',')
+            return self._registry[model_name].browse(self._cr, self._uid, int(res_id), context=self._context.copy())
+        record = IMD.get_object(self._cr, self._uid, module, identifier)
+        self._cache.set(key, makeref(record._name, record.id))
+        return record
 
 
     def xmlid_id(self, module_or_dotted_xmlid, xmlid=None):
@@ -132,6 +151,76 @@ class Lookup(object):
         else:
             return ids[0]
 
+    def index_ids(self, model, key_fields, domain):
+        """Return a dictionary mapping key values to ids of records matching domain.
+
+        This resolves many records with one search and one read, instead of
+        calling exactly_one_id in a loop.
+
+        key_fields: Field name, or list of field names, to index by.
+                    Many2one fields are indexed by their numeric id.
+        domain: Domain of the records to index
+
+        If key_fields is a single field name the keys are plain values,
+        otherwise they are tuples in the order of key_fields.
+
+        e.g.
+
+            lookup.index_ids('account.account', ['company_id', 'code'],
+                [('company_id', 'in', [1, 2]), ('code', 'in', ['100000', '200000'])],
+            )
+            # => {(1, '100000'): 12, (1, '200000'): 13, (2, '100000'): 97, ...}
+
+        Raises TooManyRecordsError if more than one record has the same key.
+        """
+        modobj = self._autoresolve_model(model)
+        single = isinstance(key_fields, (str, unicode))
+        fields = [key_fields] if single else list(key_fields)
+        context = self._context.copy()
+        ids = modobj.search(self._cr, self._uid, domain, context=context)
+        index = {}
+        for record in modobj.read(self._cr, self._uid, ids, fields, context=context):
+            key = tuple(_plain_value(record[f]) for f in fields)
+            if single:
+                key = key[0]
+            if key in index:
+                raise TooManyRecordsError("More than one record with %r = %r matching %r"
+                    % (key_fields, key, domain))
+            index[key] = record['id']
+        return index
+
+    def account_ids(self, companies_and_codes):
+        """Return a dictionary mapping (company_id, code) to account id.
+
+        companies_and_codes: Iterable of (company, code) pairs, where company is
+                             a res.company object or its numeric id.
+
+        All the accounts are resolved in one query.
+
+        Raises NoRecordsError if any of the accounts can't be found.
+        """
+        return self._company_code_ids('account.account', 'code', companies_and_codes)
+
+    def tax_ids(self, companies_and_codes):
+        """Return a dictionary mapping (company_id, tax_code) to account.tax id.
+
+        Like account_ids(), but tax_code is the 'description' field on account.tax.
+        """
+        return self._company_code_ids('account.tax', 'description', companies_and_codes)
+
+    def _company_code_ids(self, model, code_field, companies_and_codes):
+        wanted = set((_plain_id(company), code) for (company, code) in companies_and_codes)
+        if not wanted:
+            return {}
+        index = self.index_ids(model, ['company_id', code_field], [
+            ('company_id', 'in', list(set(c for (c, _) in wanted))),
+            (code_field, 'in', list(set(code for (_, code) in wanted))),
+        ])
+        missing = wanted - set(index)
+        if missing:
+            raise NoRecordsError("No %s matching (company_id, %s) in %r" % (model, code_field, sorted(missing)))
+        return dict((key, index[key]) for key in wanted)
+
     def _autoresolve_model(self, model):
         return self.model(model) if isinstance(model, (str, unicode)) else model
 
@@ -149,10 +238,19 @@ class Lookup(object):
     def field_id(self, model_name, field_name):
         """Return the id for a model field's record in the Odoo database.
         """
-        return self.exactly_one_id('ir.model.fields', [
+        return self._cached('field:%s.%s' % (model_name, field_name), lambda: self.exactly_one_id('ir.model.fields', [
             ('model', '=', model_name),
             ('name', '=', field_name),
-        ])
+        ]))
+
+    def _cached(self, key, resolve):
+        if self._cache is None:
+            return resolve()
+        value = self._cache.get(key)
+        if value is None:
+            value = resolve()
+            self._cache.set(key, value)
+        return value
 
     def _app_group_id(self, category_name, group_name):
 
@@ -171,23 +269,23 @@ class Lookup(object):
             # ids = [i for (i,) in results]
             # assert len(ids) == 1, "not exactly one match"
             # return ids[0]
-            return self.exactly_one_id('res.groups',
+            return self._cached('group:%s/%s' % (category_name, group_name), lambda: self.exactly_one_id('res.groups',
                [
                    ('category_id.name', '=', category_name),
                    ('name', '=', group_name),
                ],
-            )
+            ))
         else:
             return False
 
 
 class Config(object):
-    def __init__(self, cr, registry, uid, context=None):
+    def __init__(self, cr, registry, uid, context=None, cache=None):
         self._cr = cr
         self._registry = registry
         self._uid = uid
         self._context = context or {}
-        self._lookup = Lookup(cr, registry, uid, context=context)
+        self._lookup = Lookup(cr, registry, uid, context=context, cache=cache)
 
 
     def set_ordinary_default(self, model, field_name, value, for_all_users=True, company_id=False, condition=False):
@@ -408,28 +506,406 @@ class Config(object):
             context=context,
         )
 
-    def set_settings(self, settings_model_name, changes, company=None):
+    def set_settings(self, settings_model_name, changes, company=None, defer=False):
         """Update and execute a settings form.
 
         settings_model_name: for example 'account.config.settings' or 'base.config.settings'
         changes: Dictionary mapping field names to their new values.
         company: If defined, will create or find a config object matching company_id == company.id
+        defer: If True, queue the changes to be applied by a settings_jobs worker
+               after this transaction commits, and return the job id
         """
+        if defer:
+            return settings_jobs.enqueue_settings(self._cr, settings_model_name, changes, company=company,
+                context=self._context)
         settings_model = self._registry[settings_model_name]
         domain = [('company_id', '=', company.id)] if company else []
-        settings_id = Lookup(self._cr, self._registry, self._uid, context=self._context).maybe_id(settings_model, domain)
-        if settings_id is None:
-            data = settings_model.default_get(self._cr, self._uid,
-                list(settings_model.fields_get(self._cr, self._uid, context=self._context)),
-                context=self._context,
+        settings_id = self._lookup.maybe_id(settings_model, domain)
+        _apply_settings(self._cr, self._registry, self._uid, settings_model_name, settings_id,
+            changes=changes, company=company, context=self._context,
+        )
+
+    def for_companies(self, companies):
+        """Return a CompanyFanOut applying company-specific configuration to all of companies.
+
+        companies: List of res.company objects
+
+        e.g.
+
+            config.for_companies(companies) \
+                .enable_multi_currency('7700', '7710') \
+                .set_default_taxes('ST1', 'PT1') \
+                .apply()
+        """
+        return CompanyFanOut(self._cr, self._registry, self._uid, companies, context=self._context)
+
+    def settings_scheduler(self):
+        """Return a SettingsScheduler, to apply many settings changes with one module install pass.
+        """
+        return SettingsScheduler(self._cr, self._registry, self._uid, context=self._context)
+
+    def bulk_load(self, model, rows, chunk_size=500, references=None, xmlid_field='xmlid', xmlid_module='__import__',
+                  tracking_disable=False, noupdate=True):
+        """Create records of model from an iterable of dictionaries.  Return the number created.
+
+        Meant for master data too big for a loop of create() and Lookup calls,
+        e.g. charts of accounts or partners read from a file by a generator.
+        Rows are consumed chunk_size at a time, so memory use doesn't grow with
+        the number of rows.
+
+        model: Name of the model to create records of
+        rows: Iterable of dictionaries of field values
+        chunk_size: Number of rows to resolve and create at a time
+        references: Dictionary mapping columns to how their values are looked up:
+                        {column: (model_name, key_field)}
+                    or with a domain restricting the records that can match:
+                        {column: (model_name, key_field, domain)}
+                    key_field can be a list of fields, in which case the row value must
+                    be a tuple (or list) in the same order.  False/None values are left as False.
+        xmlid_field: Column holding an optional XMLID to register for each new record,
+                     either 'module.name' or just 'name'
+        xmlid_module: Module for XMLIDs given without one
+        noupdate: noupdate flag of the registered XMLIDs.  True stops a later update of
+                  xmlid_module from overwriting or deleting the records.
+        tracking_disable: If True, create with tracking_disable in the context, so models
+                          inheriting mail.thread don't log creation messages or track fields
+
+        e.g.
+
+            config.bulk_load('account.account', read_chart_rows(path),
+                references={
+                    'parent_id': ('account.account', ['company_id', 'code']),
+                    'user_type': ('account.account.type', 'code'),
+                },
+            )
+
+        with rows like
+
+            {'xmlid': 'uk_chart.acc_4000', 'company_id': 1, 'code': '4000', 'name': 'Sales',
+             'parent_id': (1, '4'), 'user_type': 'income', 'type': 'other'}
+
+        The reference columns of a chunk are resolved with one read per column.
+        A reference may point at a record created earlier by the same load,
+        as long as that row comes first.
+
+        A row whose XMLID already exists, from an earlier load or an earlier
+        row of this one, is skipped rather than created again.
+
+        Raises NoRecordsError if a reference can't be resolved.
+        """
+        references = dict(
+            (column, tuple(spec) + ((),) * (3 - len(spec)))
+            for (column, spec) in (references or {}).items()
+        )
+        model_obj = self._registry[model]
+        context = dict(self._context)
+        if tracking_disable:
+            context['tracking_disable'] = True
+        rows = iter(rows)
+        count = 0
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            chunk_xmlids = [self._split_xmlid(row.get(xmlid_field), xmlid_module) for row in chunk]
+            # Earlier chunks' XMLIDs are in ir_model_data by now, so this catches them too
+            registered = self._existing_xmlids(set(chunk_xmlids) - set([None]))
+            indexes = dict(
+                (column, self._bulk_load_index(spec, chunk, column))
+                for (column, spec) in references.items()
             )
-            data.update(changes)
-            if company:
-                data['company_id'] = company.id
-            settings_id = settings_model.create(self._cr, self._uid, data, context=self._context)
+            xmlids = []
+            for (row, xmlid) in zip(chunk, chunk_xmlids):
+                if xmlid in registered:
+                    _logger.debug('bulk_load: Skipping %s, XMLID %s.%s already exists' % ((model,) + xmlid))
+                    continue
+                values = dict(row)
+                values.pop(xmlid_field, None)
+                for (column, (ref_model, key_field, _)) in references.items():
+                    key = _reference_key(values.get(column))
+                    if key is None:
+                        values[column] = False
+                    elif key in indexes[column]:
+                        values[column] = indexes[column][key]
+                    else:
+                        raise NoRecordsError("No %s with %s = %r for %s" % (ref_model, key_field, key, column))
+                new_id = model_obj.create(self._cr, self._uid, values, context=context)
+                for (column, (ref_model, key_field, _)) in references.items():
+                    # So later rows in this chunk can refer to this one
+                    if ref_model == model:
+                        fields = [key_field] if isinstance(key_field, (str, unicode)) else key_field
+                        if all(f in values for f in fields):
+                            key = tuple(values[f] for f in fields)
+                            indexes[column][key[0] if len(fields) == 1 else key] = new_id
+                if xmlid:
+                    registered.add(xmlid)
+                    xmlids.append(xmlid + (model, new_id))
+                count += 1
+            self._register_xmlids(xmlids, noupdate=noupdate)
+            _logger.debug('bulk_load: Created %d %s records' % (count, model))
+        if count:
+            self._registry['ir.model.data'].clear_caches()
+        return count
+
+    def _bulk_load_index(self, spec, chunk, column):
+        ref_model, key_field, domain = spec
+        keys = set(_reference_key(row.get(column)) for row in chunk)
+        keys.discard(None)
+        if not keys:
+            return {}
+        if isinstance(key_field, (str, unicode)):
+            key_domain = [(key_field, 'in', list(keys))]
         else:
-            settings_model.write(self._cr, self._uid, [settings_id], changes, context=self._context)
-        settings_model.execute(self._cr, self._uid, [settings_id], context=self._context)
+            key_domain = [
+                (field, 'in', list(set(key[i] for key in keys)))
+                for (i, field) in enumerate(key_field)
+            ]
+        return self._lookup.index_ids(ref_model, key_field, list(domain) + key_domain)
+
+    def _split_xmlid(self, xmlid, default_module):
+        if not xmlid:
+            return None
+        module, _, name = xmlid.rpartition('.')
+        return (module or default_module, name)
+
+    def _existing_xmlids(self, xmlids):
+        """Return the set of (module, name) pairs out of xmlids that are already in ir_model_data.
+        """
+        if not xmlids:
+            return set()
+        self._cr.execute("SELECT module, name FROM ir_model_data WHERE (module, name) IN %s", (tuple(xmlids),))
+        return set(self._cr.fetchall())
+
+    def _register_xmlids(self, xmlids, noupdate=True):
+        """Insert (module, name, model, res_id) tuples into ir_model_data with one statement.
+        """
+        if not xmlids:
+            return
+        row_sql = "(%s, %s, %s, %s, %s, now() at time zone 'UTC', now() at time zone 'UTC', %s, %s, now() at time zone 'UTC', now() at time zone 'UTC')"
+        params = []
+        for (module, name, model, res_id) in xmlids:
+            params.extend([module, name, model, res_id, bool(noupdate), self._uid, self._uid])
+        self._cr.execute(
+            "INSERT INTO ir_model_data (module, name, model, res_id, noupdate, date_init, date_update,"
+            " create_uid, write_uid, create_date, write_date) VALUES "
+            + ', '.join([row_sql] * len(xmlids)),
+            params,
+        )
+
+
+class CompanyFanOut(object):
+    """Applies the same company-specific configuration to many companies.
+
+    The accounts and taxes needed by all the companies are looked up with one
+    read per model as each operation is added.  The resulting changes are
+    collected, and apply() executes each settings form once per company with
+    all its changes merged.
+
+    Nothing is written until apply() is called.
+
+    Get one from Config#for_companies.
+    """
+    def __init__(self, cr, registry, uid, companies, context=None):
+        self._cr = cr
+        self._registry = registry
+        self._uid = uid
+        self._companies = list(companies)
+        self._context = context or {}
+        self._lookup = Lookup(cr, registry, uid, context=context)
+        self._models = []
+        self._changes = {}
+
+
+    def enable_multi_currency(self, gain_account_code, loss_account_code):
+        """Set up multi-currency support on all the companies.
+
+        See enable_multi_currency()
+        """
+        account_ids = self._lookup.account_ids(
+            (company, code)
+            for company in self._companies
+            for code in (gain_account_code, loss_account_code)
+        )
+        return self.set_account_settings({'group_multi_currency': True}, per_company=dict(
+            (company.id, {
+                'income_currency_exchange_account_id': account_ids[(company.id, gain_account_code)],
+                'expense_currency_exchange_account_id': account_ids[(company.id, loss_account_code)],
+            })
+            for company in self._companies
+        ))
+
+
+    def set_default_taxes(self, sales_code, purchase_code):
+        """Set the default tax codes for all the companies.
+
+        See Config#set_default_taxes
+        """
+        tax_ids = self._lookup.tax_ids(
+            (company, code)
+            for company in self._companies
+            for code in (sales_code, purchase_code)
+        )
+        return self.set_account_settings({}, per_company=dict(
+            (company.id, {
+                'default_sale_tax': tax_ids[(company.id, sales_code)],
+                'default_purchase_tax': tax_ids[(company.id, purchase_code)],
+            })
+            for company in self._companies
+        ))
+
+
+    def set_account_settings(self, changes, per_company=None):
+        """Schedule a bunch of accounts settings on all the companies.
+
+        changes: Dictionary of changes to apply to every company
+        per_company: Dictionary mapping company id to further changes for that company only
+        """
+        return self.set_settings('account.config.settings', changes, per_company=per_company)
+
+
+    def set_settings(self, settings_model_name, changes, per_company=None):
+        """Schedule changes to a company-specific settings form for each company.
+
+        changes, per_company: As for set_account_settings
+
+        Later changes to the same field override earlier ones.
+        """
+        if settings_model_name not in self._models:
+            self._models.append(settings_model_name)
+        per_company = per_company or {}
+        for company in self._companies:
+            merged = self._changes.setdefault((settings_model_name, company.id), {})
+            merged.update(changes)
+            merged.update(per_company.get(company.id, {}))
+        return self
+
+
+    def apply(self):
+        """Execute each settings form once per company with all the changes scheduled for it.
+        """
+        company_ids = [company.id for company in self._companies]
+        for settings_model_name in self._models:
+            settings_ids = self._lookup.index_ids(settings_model_name, 'company_id',
+                [('company_id', 'in', company_ids)],
+            )
+            for company in self._companies:
+                changes = self._changes.pop((settings_model_name, company.id), None)
+                if not changes:
+                    continue
+                _apply_settings(self._cr, self._registry, self._uid, settings_model_name,
+                    settings_ids.get(company.id),
+                    changes=changes,
+                    company=company,
+                    context=self._context,
+                )
+        self._models = []
+        self._changes = {}
+        return self
+
+
+class SettingsScheduler(object):
+    """Collects changes to settings forms and applies them together.
+
+    Every settings form whose execute() installs modules triggers its own
+    module installation and registry reload.  This collects the module_*
+    flags from all the pending changes, installs all those modules with one
+    button_immediate_install, then executes each settings form once with
+    its merged changes.
+
+    e.g.
+
+        scheduler = config.settings_scheduler()
+        scheduler.set_general_settings({'module_multi_company': True})
+        scheduler.set_sale_settings({'module_sale_margin': True, 'group_discount_per_so_line': True})
+        scheduler.set_warehouse_settings({'module_stock_dropshipping': True})
+        scheduler.apply()
+
+    Nothing is written until apply() is called.
+    """
+    def __init__(self, cr, registry, uid, context=None):
+        self._cr = cr
+        self._registry = registry
+        self._uid = uid
+        self._context = context or {}
+        self._pending = []
+        self._changes = {}
+
+
+    def set_settings(self, settings_model_name, changes, company=None):
+        """Schedule changes to a settings form.
+
+        Arguments as per Config#set_settings.  Changes to the same form
+        (and company) are merged, with later values overriding earlier ones.
+        """
+        key = (settings_model_name, company.id if company else None)
+        if key not in self._changes:
+            self._pending.append((settings_model_name, company))
+            self._changes[key] = {}
+        self._changes[key].update(changes)
+        return self
+
+    def set_account_settings(self, changes, company):
+        return self.set_settings('account.config.settings', changes, company=company)
+
+    def set_general_settings(self, changes):
+        return self.set_settings('base.config.settings', changes)
+
+    def set_purchasing_settings(self, changes):
+        return self.set_settings('purchase.config.settings', changes)
+
+    def set_sale_settings(self, changes):
+        return self.set_settings('sale.config.settings', changes)
+
+    def set_warehouse_settings(self, changes):
+        return self.set_settings('stock.config.settings', changes)
+
+
+    def modules_to_install(self):
+        """Return sorted list of names of modules ticked in the pending changes.
+        """
+        return sorted(set(
+            field[len('module_'):]
+            for changes in self._changes.values()
+            for (field, value) in changes.items()
+            if field.startswith('module_') and value
+        ))
+
+
+    def apply(self):
+        """Install all the scheduled modules in one go, then execute each settings form once.
+
+        Returns the registry, which is a new one if any modules were installed.
+        """
+        cr, uid = self._cr, self._uid
+        module_names = self.modules_to_install()
+        if module_names:
+            modules = self._registry['ir.module.module']
+            module_ids = modules.search(cr, uid,
+                [('name', 'in', module_names), ('state', 'in', ['uninstalled', 'to install'])],
+                context=self._context.copy(),
+            )
+            if module_ids:
+                _logger.debug('SettingsScheduler: Installing modules %s' % (', '.join(module_names),))
+                modules.button_immediate_install(cr, uid, module_ids, context=self._context.copy())
+                # Installing reloads the registry, and later forms may need fields from the new modules
+                from openerp.modules.registry import RegistryManager
+                self._registry = RegistryManager.get(cr.dbname)
+
+        # module_* fields are still written, so execute() sees the ticked ones as
+        # already installed and still uninstalls the unticked ones.
+        lookup = Lookup(cr, self._registry, uid, context=self._context)
+        for (settings_model_name, company) in self._pending:
+            domain = [('company_id', '=', company.id)] if company else []
+            _apply_settings(cr, self._registry, uid, settings_model_name,
+                lookup.maybe_id(settings_model_name, domain),
+                changes=self._changes[(settings_model_name, company.id if company else None)],
+                company=company,
+                context=self._context,
+            )
+        self._pending = []
+        self._changes = {}
+        return self._registry
+
 
 def set_default_customer_sale_pricelist(cr, registry, uid, company, pricelist, context=None):
     """DEPRECATED: Set the default customer sale pricelist for a company.
@@ -566,16 +1042,33 @@ def get_account_id(cr, registry, uid, company, code, context=None):
     )
 
 
-def set_settings(cr, registry, uid, settings_model_name, changes, company=None, context=None):
+def set_settings(cr, registry, uid, settings_model_name, changes, company=None, context=None, defer=False):
     """Update and execute a settings form.
 
     settings_model_name: for example 'account.config.settings' or 'base.config.settings'
     changes: Dictionary mapping field names to their new values.
     company: If defined, will create or find a config object matching company_id == company.id
+    defer: If True, queue the changes to be applied by a settings_jobs worker
+           after this transaction commits, and return the job id
     """
+    if defer:
+        return settings_jobs.enqueue_settings(cr, settings_model_name, changes, company=company, context=context)
     settings_model = registry[settings_model_name]
     domain = [('company_id', '=', company.id)] if company else []
     settings_id = Lookup(cr, registry, uid, context=context).maybe_id(settings_model, domain)
+    _apply_settings(cr, registry, uid, settings_model_name, settings_id,
+        changes=changes, company=company, context=context,
+    )
+
+
+def _apply_settings(cr, registry, uid, settings_model_name, settings_id, changes, company=None, context=None):
+    """Write changes to the settings form settings_id (or create one if it's None) and execute it.
+    """
+    settings_model = registry[settings_model_name]
+    if (context or {}).get(concurrent_companies.LOCKS_CONTEXT_KEY):
+        concurrent_companies.advisory_lock(cr,
+            concurrent_companies.settings_resources(settings_model_name, changes, company),
+        )
     if settings_id is None:
         data = settings_model.default_get(cr, uid,
             list(settings_model.fields_get(cr, uid, context=context)),
@@ -615,6 +1108,98 @@ def create_consolidation_account(cr, registry, uid, company, code, name, childre
     return registry['account.account'].create(cr, uid, data, context=context)
 
 
+def create_consolidation_accounts(cr, registry, uid, tree, context=None):
+    """Create a whole hierarchy of consolidation accounts, for one or many companies.
+
+    Return a dictionary mapping (company_id, code) to the id of each new account.
+
+    tree: List of (company, code, name, children) tuples, where
+        company: The company that will own the new consolidation account
+        code: Code for the new consolidation account
+        name: Name for the new consolidation account
+        children: List of child account codes.  A plain code refers to an account
+                  of the same company; use a (company, code) tuple to refer to an
+                  account of another company.  Children may be other consolidation
+                  accounts from the same tree.
+
+    e.g.
+
+        create_consolidation_accounts(cr, registry, SUPERUSER_ID, [
+            (group, 'C1000', 'Group Sales', [(uk, '400000'), (fr, '706000')]),
+            (group, 'C0000', 'Group P&L', ['C1000', 'C2000']),
+            ...
+        ], context=context.copy())
+
+    Existing child accounts are resolved in one query, and the 'Root/View'
+    account type is only looked up once.
+    """
+    lookup = Lookup(cr, registry, uid, context=context)
+    nodes = {}
+    for (company, code, name, children) in tree:
+        key = (_plain_id(company), code)
+        if key in nodes:
+            raise ValueError("Consolidation account %r appears more than once" % (key,))
+        nodes[key] = (name, [
+            (_plain_id(child[0]), child[1]) if isinstance(child, tuple) else (key[0], child)
+            for child in children
+        ])
+
+    existing = lookup.account_ids(set(
+        child for (_, children) in nodes.values() for child in children if child not in nodes
+    ))
+    account_type_view_id = lookup.exactly_one_id('account.account.type', [('name', '=', 'Root/View')])
+    accounts_model = registry['account.account']
+
+    ADD_EXISTING_ID = 4
+    created = {}
+    visiting = set()
+
+    def create(key):
+        if key in created:
+            return created[key]
+        if key in visiting:
+            raise ValueError("Consolidation account %r is its own descendant" % (key,))
+        visiting.add(key)
+        name, children = nodes[key]
+        child_ids = [create(child) if child in nodes else existing[child] for child in children]
+        created[key] = accounts_model.create(cr, uid, {
+            'company_id': key[0],
+            'code': key[1],
+            'name': name,
+            'type': 'consolidation',
+            'user_type': account_type_view_id,
+            'child_consol_ids': [
+                (ADD_EXISTING_ID, child_id, False) for child_id in child_ids
+            ],
+        }, context=context)
+        visiting.discard(key)
+        return created[key]
+
+    for (company, code, _, _) in tree:
+        create((_plain_id(company), code))
+    return created
+
+
+def _reference_key(value):
+    """Return a bulk_load reference value as a hashable key, or None if there's no reference.
+    """
+    if value is None or value is False:
+        return None
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _plain_id(record):
+    """Return the numeric id of a browse record, or the argument if it's already an id.
+    """
+    return record if isinstance(record, (int, long)) else record.id
+
+
+def _plain_value(value):
+    """Return value as read() returns it, with many2one (id, name) pairs reduced to the id.
+    """
+    return value[0] if isinstance(value, (tuple, list)) and len(value) == 2 else value
+
+
 
 def makeref(model_name, identifier):
     """Return a string reference for an object in the database.
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Skip configuration code whose inputs haven't changed since it last ran.
+
+A configuration function declares its inputs: a spec (any JSON-serialisable
+description of what it configures), the modules it depends on, and the
+companies it configures.  A fingerprint of those is stored in
+ir.config_parameter after a successful run, and the next run is skipped if
+the fingerprint is the same.
+
+    @fingerprinted('my_module.configure_sales', spec=SALES_SETTINGS, modules=['sale', 'crm'])
+    def post_init_hook(cr, registry):
+        ...
+
+Set the environment variable CONFUTIL_FORCE to run everything regardless.
+"""
+
+from hashlib import sha1
+import functools
+import json
+import os
+
+import logging
+
+from .lookup_cache import module_versions
+
+_logger = logging.getLogger(__name__)
+
+PARAMETER_PREFIX = 'confutil.fingerprint.'
+
+
+def fingerprint_parts(cr, spec=None, modules=(), company_ids=None):
+    """Return dictionary of hashes of each of the declared inputs.
+
+    company_ids: Ids of the companies configured, or None for all companies
+    """
+    if company_ids is None:
+        cr.execute('SELECT id FROM res_company')
+        company_ids = [company_id for (company_id,) in cr.fetchall()]
+    return {
+        'spec': _digest(spec),
+        'modules': _digest(module_versions(cr, modules) if modules else {}),
+        'companies': _digest(sorted(company_ids)),
+    }
+
+
+def run_if_changed(cr, registry, uid, name, func, spec=None, modules=(), company_ids=None, force=False, context=None):
+    """Call func() unless its inputs are unchanged since it last ran successfully.
+
+    name: Unique name for this piece of configuration, e.g. 'my_module.configure_sales'
+    func: Function to call, with no arguments
+    spec: JSON-serialisable description of what func configures
+    modules: Names of the modules whose versions func depends on
+    company_ids: Ids of the companies func configures, or None for all companies
+    force: Call func even if nothing has changed
+
+    Return True if func was called, False if it was skipped.
+    """
+    parameters = registry['ir.config_parameter']
+    key = PARAMETER_PREFIX + name
+    parts = fingerprint_parts(cr, spec=spec, modules=modules, company_ids=company_ids)
+    stored = parameters.get_param(cr, uid, key, default=False, context=context)
+    previous = json.loads(stored) if stored else None
+
+    if force or os.environ.get('CONFUTIL_FORCE'):
+        reason = 'forced'
+    elif previous is None:
+        reason = 'never run before'
+    else:
+        changed = sorted(part for part in parts if previous.get(part) != parts[part])
+        if not changed:
+            _logger.info('%s: Skipping, inputs unchanged since last run' % (name,))
+            return False
+        reason = 'changed ' + ', '.join(changed)
+
+    _logger.info('%s: Running (%s)' % (name, reason))
+    func()
+    parameters.set_param(cr, uid, key, json.dumps(parts, sort_keys=True), context=context)
+    return True
+
+
+def fingerprinted(name, spec=None, modules=(), force=False):
+    """Decorator applying run_if_changed to a hook called as hook(cr, registry).
+
+    All companies in the database count as the configured companies.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(cr, registry):
+            from openerp import SUPERUSER_ID
+            run_if_changed(cr, registry, SUPERUSER_ID, name,
+                lambda: func(cr, registry),
+                spec=spec,
+                modules=modules,
+                force=force,
+            )
+        return wrapper
+    return decorator
+
+
+def _digest(value):
+    return sha1(json.dumps(value, sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
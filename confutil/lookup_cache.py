@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Persistent on-disk cache of Lookup resolutions.
+
+XMLID, field and group ids hardly ever change between runs of an installation
+hook, so they can be remembered from one run to the next:
+
+    cache = LookupCache.open(cr)
+    lookup = Lookup(cr, registry, SUPERUSER_ID, context=context.copy(), cache=cache)
+    ...
+    cache.save()
+
+The cache file belongs to one database (by name and database.uuid) and one set
+of installed module versions.  If any of those has changed since the file was
+written, the whole cache is discarded.  So is a file not owned by the current
+user, or writable by anyone else.
+
+The cache may be saved before the transaction commits, and the installation
+can still roll back afterwards.  open() therefore checks the cached ids
+against the database (one query per kind of entry) and drops any that no
+longer match.
+"""
+
+from hashlib import sha1
+import mmap
+import os
+import stat
+import tempfile
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = 'CONFUTIL-LOOKUP-CACHE 1'
+
+
+class LookupCache(object):
+    """Mapping of lookup keys to ids, backed by a file.
+
+    path: File to load from and save to
+    dbname: Name of the database the ids belong to
+    signature: Signature of the installed modules, as returned by module_signature()
+    database_uuid: The database's database.uuid parameter, so a database dropped
+                   and created again under the same name doesn't reuse the ids
+
+    Usually created with LookupCache.open(cr).
+    """
+    def __init__(self, path, dbname, signature, database_uuid=None):
+        self.path = path
+        self.dbname = dbname
+        self.signature = signature
+        self.database_uuid = database_uuid
+        self._entries = {}
+        self._dirty = False
+        self._load()
+
+
+    @classmethod
+    def open(cls, cr, path=None):
+        """Return the cache for the database cr is connected to.
+
+        path: Cache file.  Defaults to one per database in default_directory().
+        """
+        dbname = cr.dbname
+        if path is None:
+            path = os.path.join(default_directory(), 'lookup-%s.cache' % (dbname,))
+        cr.execute("SELECT value FROM ir_config_parameter WHERE key = 'database.uuid'")
+        row = cr.fetchone()
+        cache = cls(path, dbname, module_signature(cr), database_uuid=row[0] if row else None)
+        cache.validate(cr)
+        return cache
+
+
+    def validate(self, cr):
+        """Drop entries whose ids are no longer in the database.  Return the number dropped.
+
+        A cache saved from a transaction that was later rolled back can refer
+        to XMLIDs, fields and groups that were never committed.
+        """
+        by_kind = {}
+        for key in self._entries:
+            kind, _, name = key.partition(':')
+            by_kind.setdefault(kind, {})[name] = key
+        stale = []
+        xmlids = by_kind.pop('xmlid', {})
+        if xmlids:
+            cr.execute("SELECT module, name, model, res_id FROM ir_model_data WHERE (module, name) IN %s",
+                (tuple(tuple(name.split('.', 1)) for name in xmlids),))
+            found = dict(('%s.%s' % (module, name), '%s,%s' % (model, res_id)) for (module, name, model, res_id) in cr.fetchall())
+            stale.extend(key for (name, key) in xmlids.items() if found.get(name) != self._entries[key])
+        for (kind, table) in [('field', 'ir_model_fields'), ('group', 'res_groups')]:
+            keys = by_kind.pop(kind, {}).values()
+            if keys:
+                cr.execute('SELECT id FROM %s WHERE id IN %%s' % (table,), (tuple(self._entries[key] for key in keys),))
+                found = set(row[0] for row in cr.fetchall())
+                stale.extend(key for key in keys if self._entries[key] not in found)
+        # Nothing else is stored, so anything left is from an unknown version
+        for keys in by_kind.values():
+            stale.extend(keys.values())
+        for key in stale:
+            del self._entries[key]
+        if stale:
+            _logger.debug('LookupCache: Dropped %d entries no longer in the database' % (len(stale),))
+            self._dirty = True
+        return len(stale)
+
+
+    def get(self, key):
+        """Return the cached value for key, or None.
+        """
+        return self._entries.get(key)
+
+    def set(self, key, value):
+        if self._entries.get(key) != value:
+            self._entries[key] = value
+            self._dirty = True
+
+    def clear(self):
+        if self._entries:
+            self._entries = {}
+            self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def save(self):
+        """Write the cache to its file, if anything has changed.
+        """
+        if not self._dirty:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(prefix='.confutil-lookup-', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(self._header())
+                for key in sorted(self._entries):
+                    f.write(('%s\t%s\n' % (key, self._entries[key])).encode('utf-8'))
+            os.rename(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        self._dirty = False
+
+
+    def _header(self):
+        return ('%s %s %s %s\n' % (MAGIC, self.dbname, self.database_uuid, self.signature)).encode('utf-8')
+
+    def _load(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+        with f:
+            info = os.fstat(f.fileno())
+            if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+                _logger.warning('LookupCache: Ignoring %s, it is not owned by this user or is writable by others' % (self.path,))
+                self._dirty = True
+                return
+            if info.st_size == 0:
+                return
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if data.readline() != self._header():
+                    _logger.debug('LookupCache: Discarding %s, it was written for other module versions' % (self.path,))
+                    self._dirty = True
+                    return
+                entries = {}
+                for line in iter(data.readline, b''):
+                    key, _, value = line.decode('utf-8').rstrip('\n').partition('\t')
+                    entries[key] = int(value) if value.isdigit() else value
+                self._entries = entries
+            finally:
+                data.close()
+
+
+def default_directory():
+    """Return a directory private to the current user for cache files, creating it if necessary.
+
+    This is a confutil directory in Odoo's data_dir, or in ~/.cache if Odoo isn't available.
+    """
+    try:
+        from openerp.tools import config
+        base = config['data_dir']
+    except ImportError:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    directory = os.path.join(base, 'confutil')
+    if not os.path.isdir(directory):
+        os.makedirs(directory, 0o700)
+    info = os.stat(directory)
+    if info.st_uid != os.getuid() or info.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise IOError('%s is not private to this user, refusing to keep a lookup cache there' % (directory,))
+    return directory
+
+
+def module_versions(cr, names=None):
+    """Return dictionary mapping installed module names to their versions.
+
+    names: If given, only these modules are included.
+    """
+    if names is None:
+        cr.execute("SELECT name, latest_version FROM ir_module_module WHERE state = 'installed'")
+    else:
+        cr.execute("SELECT name, latest_version FROM ir_module_module WHERE state = 'installed' AND name IN %s",
+            (tuple(names) or (None,),))
+    return dict(cr.fetchall())
+
+
+def module_signature(cr, names=None):
+    """Return a short hash of the installed module versions.
+    """
+    versions = module_versions(cr, names)
+    digest = sha1()
+    for name in sorted(versions):
+        digest.update(('%s=%s;' % (name, versions[name])).encode('utf-8'))
+    return digest.hexdigest()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Count the SQL statements and ORM calls made by a block of configuration code.
+
+Use it to catch N+1 lookups creeping into installation hooks:
+
+    with QueryBudget(cr, max_queries=20, max_orm_calls=5):
+        config.for_companies(companies).set_default_taxes('ST1', 'PT1').apply()
+
+or as a decorator on a hook taking the cursor as its first argument:
+
+    @query_budget(max_queries=200, log_only=True)
+    def post_init_hook(cr, registry):
+        ...
+
+Statements are counted on cr.execute, so any object with an execute() method
+(e.g. a stand-in cursor in a test) can be used.  ORM calls are the outermost
+calls into openerp.models methods such as search(), read() and write().
+"""
+
+from collections import defaultdict
+import functools
+import os
+import sys
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+_PACKAGE = __name__.rsplit('.', 1)[0]
+
+ORM_METHODS = frozenset([
+    'search', 'search_read', 'search_count', 'read', 'browse', 'create', 'write',
+    'unlink', 'default_get', 'fields_get', 'name_search', 'name_get',
+])
+
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+
+class QueryBudget(object):
+    """Context manager counting SQL statements and ORM calls on a cursor.
+
+    cr: The cursor to watch
+    max_queries: Number of SQL statements allowed, or None for no limit
+    max_orm_calls: Number of ORM calls allowed, or None for no limit
+    log_only: If True, a blown budget is logged as a warning instead of raising
+              QueryBudgetExceeded
+    name: Name for the block in the messages
+
+    After the block, queries and orm_calls hold the totals, and breakdown()
+    returns the counts per confutil helper and the line it was called from.
+    """
+    def __init__(self, cr, max_queries=None, max_orm_calls=None, log_only=False, name=None):
+        self._cr = cr
+        self.max_queries = max_queries
+        self.max_orm_calls = max_orm_calls
+        self.log_only = log_only
+        self.name = name or 'block'
+        self.queries = 0
+        self.orm_calls = 0
+        self._query_sites = defaultdict(int)
+        self._orm_sites = defaultdict(int)
+        self._restore = None
+        self._previous_profiler = None
+
+
+    def __enter__(self):
+        # Start from zero each time, so the same instance can decorate a function called repeatedly
+        self.queries = 0
+        self.orm_calls = 0
+        self._query_sites = defaultdict(int)
+        self._orm_sites = defaultdict(int)
+        budget = self
+        original_execute = self._cr.execute
+
+        def execute(query, *args, **kwargs):
+            budget.queries += 1
+            budget._query_sites[_call_site(sys._getframe(1))] += 1
+            return original_execute(query, *args, **kwargs)
+
+        self._restore = _hook_execute(self._cr, execute)
+        if self.max_orm_calls is not None:
+            self._previous_profiler = sys.getprofile()
+            sys.setprofile(self._profile)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.max_orm_calls is not None:
+            sys.setprofile(self._previous_profiler)
+        self._restore()
+        if exc_type is None:
+            self.check()
+        return False
+
+    def __call__(self, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self:
+                return func(*args, **kwargs)
+        return wrapper
+
+
+    def _profile(self, frame, event, arg):
+        if event != 'call' or frame.f_code.co_name not in ORM_METHODS:
+            return
+        if not _is_orm_frame(frame):
+            return
+        caller = _skip_api_frames(frame.f_back)
+        if caller is not None and _is_orm_frame(caller):
+            return
+        self.orm_calls += 1
+        self._orm_sites[_call_site(caller)] += 1
+
+
+    def breakdown(self):
+        """Return list of (helper, caller, queries, orm_calls), most queries first.
+
+        helper is the outermost confutil function or method involved
+        (e.g. 'Lookup.exactly_one_id') or None, and caller is the
+        'file:line' that called it.
+        """
+        sites = set(self._query_sites) | set(self._orm_sites)
+        rows = [
+            (helper, caller, self._query_sites.get((helper, caller), 0), self._orm_sites.get((helper, caller), 0))
+            for (helper, caller) in sites
+        ]
+        return sorted(rows, key=lambda row: (-row[2], -row[3], row[0] or '', row[1]))
+
+
+    def check(self):
+        """Raise QueryBudgetExceeded (or log, if log_only) if the budget has been exceeded.
+        """
+        over = []
+        if self.max_queries is not None and self.queries > self.max_queries:
+            over.append('%d SQL statements (budget %d)' % (self.queries, self.max_queries))
+        if self.max_orm_calls is not None and self.orm_calls > self.max_orm_calls:
+            over.append('%d ORM calls (budget %d)' % (self.orm_calls, self.max_orm_calls))
+        if not over:
+            return
+        message = '%s: %s\n%s' % (self.name, ' and '.join(over), self.format_breakdown())
+        if self.log_only:
+            _logger.warning(message)
+        else:
+            raise QueryBudgetExceeded(message)
+
+
+    def format_breakdown(self):
+        return '\n'.join(
+            '  %6d queries %6d ORM calls  %s  from %s' % (queries, orm_calls, helper or '(not confutil)', caller)
+            for (helper, caller, queries, orm_calls) in self.breakdown()
+        )
+
+
+def query_budget(max_queries=None, max_orm_calls=None, log_only=False):
+    """Decorator applying a QueryBudget to a function taking the cursor as its first argument.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(cr, *args, **kwargs):
+            budget = QueryBudget(cr,
+                max_queries=max_queries,
+                max_orm_calls=max_orm_calls,
+                log_only=log_only,
+                name=func.__name__,
+            )
+            with budget:
+                return func(cr, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _hook_execute(cr, execute):
+    """Replace cr.execute with execute.  Return a function that puts it back.
+
+    Hooks can be nested, as long as they're removed in reverse order.
+    """
+    shadowed = 'execute' in getattr(cr, '__dict__', {})
+    previous = cr.__dict__.get('execute') if shadowed else None
+    cr.execute = execute
+
+    def restore():
+        if shadowed:
+            cr.execute = previous
+        else:
+            del cr.execute
+    return restore
+
+
+def _call_site(frame):
+    """Return (helper, caller) for the code running in frame.
+
+    helper is the name of the outermost confutil function or method on the stack
+    (or None if there isn't one), and caller is 'file:line' of the frame that called it.
+    """
+    helper = None
+    caller = frame
+    while frame is not None:
+        module = frame.f_globals.get('__name__', '')
+        if module.startswith(_PACKAGE + '.') and module not in _INTERNAL_MODULES:
+            helper = _function_name(frame)
+            caller = frame.f_back
+        frame = frame.f_back
+    if caller is None:
+        return (helper, '?')
+    return (helper, '%s:%d' % (os.path.basename(caller.f_code.co_filename), caller.f_lineno))
+
+
+# Modules that hook cr.execute themselves, which mustn't be mistaken for helpers
+_INTERNAL_MODULES = frozenset([__name__, _PACKAGE + '.slow_query'])
+
+
+def _function_name(frame):
+    instance = frame.f_locals.get('self')
+    if instance is not None:
+        return '%s.%s' % (type(instance).__name__, frame.f_code.co_name)
+    return frame.f_code.co_name
+
+
+def _is_orm_frame(frame):
+    return frame.f_globals.get('__name__') == 'openerp.models'
+
+
+def _skip_api_frames(frame):
+    """Return the first frame from frame outwards that isn't one of the openerp.api call wrappers.
+    """
+    while frame is not None and frame.f_globals.get('__name__') == 'openerp.api':
+        frame = frame.f_back
+    return frame
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Apply settings forms in the background, after the installing transaction has committed.
+
+Executing a heavy settings form inside a module installation holds the
+installation's locks for as long as it takes.  Instead the changes can be
+queued in the confutil_settings_job table:
+
+    config.set_settings('stock.config.settings', changes, defer=True)
+    start_worker(cr.dbname)
+
+The jobs only become visible once the installing transaction commits, and
+the worker thread picks them up from then on.  Jobs for the same company
+(or for no company) run in the order they were queued; a failed job is
+retried up to max_attempts times before it's marked as failed, and later
+jobs for that company wait for it until then.
+
+Each job keeps the context it was queued with, and is applied with it.
+
+Use job_status() or jobs() to see how they got on.
+"""
+
+import hashlib
+import json
+import struct
+import sys
+import threading
+import time
+import traceback
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+TABLE = 'confutil_settings_job'
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_COLUMNS = ['id', 'model', 'company_id', 'changes', 'context', 'state', 'attempts', 'max_attempts',
+            'last_error', 'create_date', 'done_date']
+
+# Session-level advisory lock making sure only one worker processes a database's jobs
+_WORKER_LOCK = struct.unpack('>q', hashlib.sha1(TABLE.encode('utf-8')).digest()[:8])[0]
+
+
+def ensure_table(cr):
+    if _table_exists(cr):
+        return
+    cr.execute("""
+        CREATE TABLE confutil_settings_job (
+            id serial PRIMARY KEY,
+            model varchar NOT NULL,
+            company_id integer,
+            changes text NOT NULL,
+            context text NOT NULL DEFAULT '{}',
+            txid bigint NOT NULL DEFAULT txid_current(),
+            state varchar NOT NULL DEFAULT 'pending',
+            attempts integer NOT NULL DEFAULT 0,
+            max_attempts integer NOT NULL DEFAULT 3,
+            last_error text,
+            create_date timestamp NOT NULL DEFAULT (now() at time zone 'UTC'),
+            done_date timestamp
+        )
+    """)
+    cr.execute("""
+        CREATE INDEX confutil_settings_job_state_idx
+        ON confutil_settings_job (state, company_id, id)
+    """)
+
+
+def enqueue_settings(cr, settings_model_name, changes, company=None, max_attempts=3, context=None):
+    """Queue changes to a settings form, to be applied by a worker after commit.  Return the job id.
+
+    Arguments as per set_settings.  changes and context must be JSON-serialisable.
+
+    If the last job for the same company was queued by this same transaction and
+    is for the same settings form with the same context, the changes are merged
+    into it instead.  Jobs that have been committed are never touched, so this
+    can't conflict with a worker applying them.
+    """
+    ensure_table(cr)
+    company_id = company.id if company else None
+    context_json = json.dumps(context or {}, sort_keys=True)
+    cr.execute("""
+        SELECT id, model, changes, context FROM confutil_settings_job
+        WHERE company_id IS NOT DISTINCT FROM %s AND txid = txid_current()
+        ORDER BY id DESC LIMIT 1
+    """, (company_id,))
+    row = cr.fetchone()
+    if row and row[1] == settings_model_name and row[3] == context_json:
+        merged = json.loads(row[2])
+        merged.update(changes)
+        cr.execute("UPDATE confutil_settings_job SET changes = %s WHERE id = %s",
+            (json.dumps(merged, sort_keys=True), row[0]))
+        return row[0]
+    cr.execute("""
+        INSERT INTO confutil_settings_job (model, company_id, changes, context, max_attempts)
+        VALUES (%s, %s, %s, %s, %s) RETURNING id
+    """, (settings_model_name, company_id, json.dumps(changes, sort_keys=True), context_json, max_attempts))
+    return cr.fetchone()[0]
+
+
+def job_status(cr, job_id):
+    """Return a dictionary describing the job, or None if there isn't one with that id.
+    """
+    found = jobs(cr, job_ids=[job_id])
+    return found[0] if found else None
+
+
+def jobs(cr, state=None, company_id=None, job_ids=None):
+    """Return list of dictionaries describing queued jobs, oldest first.
+
+    state: Only jobs in this state ('pending', 'running', 'done' or 'failed')
+    company_id: Only jobs for this company
+    job_ids: Only jobs with these ids
+    """
+    if not _table_exists(cr):
+        return []
+    where, params = [], []
+    if state:
+        where.append('state = %s')
+        params.append(state)
+    if company_id:
+        where.append('company_id = %s')
+        params.append(company_id)
+    if job_ids is not None:
+        where.append('id IN %s')
+        params.append(tuple(job_ids) or (None,))
+    cr.execute('SELECT %s FROM confutil_settings_job %s ORDER BY id' % (
+        ', '.join(_COLUMNS),
+        ('WHERE ' + ' AND '.join(where)) if where else '',
+    ), params)
+    result = []
+    for row in cr.fetchall():
+        job = dict(zip(_COLUMNS, row))
+        job['changes'] = json.loads(job['changes'])
+        job['context'] = json.loads(job['context'])
+        result.append(job)
+    return result
+
+
+def process_jobs(dbname, uid=1, context=None):
+    """Apply all the pending jobs that can run now.  Return the number of jobs attempted.
+
+    Only one worker runs per database at a time; if another one holds the
+    worker lock this returns 0 straight away.
+
+    context: Base context; the context each job was queued with is applied over it
+    """
+    import openerp
+    from .confutil import set_settings
+
+    with openerp.api.Environment.manage():
+        cr = openerp.registry(dbname).cursor()
+        try:
+            if not _table_exists(cr):
+                return 0
+            cr.execute('SELECT pg_try_advisory_lock(%s)', (_WORKER_LOCK,))
+            if not cr.fetchone()[0]:
+                return 0
+            try:
+                # Holding the worker lock, so a job still running was left by a worker that died
+                cr.execute("UPDATE confutil_settings_job SET state = 'pending' WHERE state = 'running'")
+                cr.commit()
+                # Failed jobs are retried on the next call, not straight away
+                attempted = []
+                while True:
+                    job = _next_job(cr, attempted)
+                    if job is None:
+                        cr.commit()
+                        return len(attempted)
+                    job_id, model, company_id, changes, job_context = job
+                    attempted.append(job_id)
+                    # Committed before applying, so jobs() shows it in progress and a dead worker's job is retried
+                    cr.execute("UPDATE confutil_settings_job SET state = 'running' WHERE id = %s", (job_id,))
+                    cr.commit()
+                    try:
+                        job_context = dict(context or {}, **json.loads(job_context))
+                        # Installing modules replaces the registry, so fetch it each time
+                        registry = openerp.registry(dbname)
+                        company = registry['res.company'].browse(cr, uid, company_id, context=job_context) if company_id else None
+                        set_settings(cr, registry, uid, model, json.loads(changes), company=company, context=job_context)
+                        cr.execute("""
+                            UPDATE confutil_settings_job
+                            SET state = 'done', attempts = attempts + 1, last_error = NULL,
+                                done_date = (now() at time zone 'UTC')
+                            WHERE id = %s
+                        """, (job_id,))
+                        cr.commit()
+                        _logger.debug('process_jobs: Applied %s job %d' % (model, job_id))
+                    except Exception:
+                        cr.rollback()
+                        error = ''.join(traceback.format_exception(*sys.exc_info()))
+                        _logger.warning('process_jobs: %s job %d failed:\n%s' % (model, job_id, error))
+                        cr.execute("""
+                            UPDATE confutil_settings_job
+                            SET attempts = attempts + 1, last_error = %s,
+                                state = CASE WHEN attempts + 1 >= max_attempts THEN 'failed' ELSE 'pending' END
+                            WHERE id = %s
+                        """, (error, job_id))
+                        cr.commit()
+            finally:
+                cr.execute('SELECT pg_advisory_unlock(%s)', (_WORKER_LOCK,))
+                cr.commit()
+        finally:
+            cr.close()
+
+
+def start_worker(dbname, uid=1, context=None, poll_interval=2.0, idle_timeout=300.0):
+    """Start a background thread processing dbname's jobs.  Return the thread.
+
+    The thread polls every poll_interval seconds, so it picks up jobs queued by
+    a transaction that hasn't committed yet as soon as it does, and stops once
+    it has had nothing to do for idle_timeout seconds.
+    """
+    def work():
+        idle_since = time.time()
+        while time.time() - idle_since < idle_timeout:
+            try:
+                if process_jobs(dbname, uid=uid, context=context):
+                    idle_since = time.time()
+            except Exception:
+                _logger.exception('start_worker: Processing settings jobs for %s failed' % (dbname,))
+            time.sleep(poll_interval)
+
+    thread = threading.Thread(target=work, name='confutil-settings-jobs-%s' % (dbname,))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def _next_job(cr, exclude_ids):
+    """Return (id, model, company_id, changes, context) of the oldest pending job with no older pending job for its company.
+
+    """
+    cr.execute("""
+        SELECT j.id, j.model, j.company_id, j.changes, j.context
+        FROM confutil_settings_job AS j
+        WHERE j.state = 'pending'
+          AND j.id NOT IN %s
+          AND NOT EXISTS (
+              SELECT 1 FROM confutil_settings_job AS e
+              WHERE e.company_id IS NOT DISTINCT FROM j.company_id
+                AND e.state = 'pending'
+                AND e.id < j.id
+          )
+        ORDER BY j.id
+        LIMIT 1
+    """, (tuple(exclude_ids) or (0,),))
+    return cr.fetchone()
+
+
+def _table_exists(cr):
+    cr.execute("SELECT 1 FROM pg_class WHERE relkind = 'r' AND relname = %s", (TABLE,))
+    return bool(cr.fetchone())
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
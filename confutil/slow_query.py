@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Capture slow SQL statements, with their query plans, made by configuration code.
+
+    with SlowQueryTracer(cr, threshold_ms=50, report_path='/tmp/hook-slow-queries.json'):
+        post_init_hook(cr, registry)
+
+or as a decorator on a hook taking the cursor as its first argument:
+
+    @trace_slow_queries(threshold_ms=50, report_path='/tmp/hook-slow-queries.json')
+    def post_init_hook(cr, registry):
+        ...
+
+Every statement taking longer than the threshold is recorded with the confutil
+helper and the line that caused it, and the output of EXPLAIN for it.  Statements
+starting with SELECT are explained with ANALYZE, so they are run a second time
+inside a savepoint which is then rolled back; anything else is only planned.
+Sequences aren't transactional, so a SELECT calling nextval() still uses up
+values; pass analyze=False if that matters.  Plans are only available on real
+Odoo cursors, and statements that raise are never explained.
+"""
+
+import functools
+import json
+import sys
+import time
+
+import logging
+
+from .query_budget import _call_site, _hook_execute
+
+_logger = logging.getLogger(__name__)
+
+
+class SlowQueryTracer(object):
+    """Context manager recording statements on cr slower than threshold_ms.
+
+    cr: The cursor to watch
+    threshold_ms: Statements taking at least this many milliseconds are recorded
+    report_path: If given, a JSON report is written here at the end of the block
+    explain: Whether to record query plans
+    analyze: Whether to use EXPLAIN ANALYZE for SELECT statements
+
+    The recorded statements are in the entries attribute, slowest first
+    once the block has finished.
+    """
+    def __init__(self, cr, threshold_ms=100, report_path=None, explain=True, analyze=True):
+        self._cr = cr
+        self.threshold_ms = threshold_ms
+        self.report_path = report_path
+        self.explain = explain
+        self.analyze = analyze
+        self.entries = []
+        self.total_queries = 0
+        self._restore = None
+
+
+    def __enter__(self):
+        tracer = self
+        original_execute = self._cr.execute
+
+        def execute(query, params=None, *args, **kwargs):
+            start = time.time()
+            tracer.total_queries += 1
+            # If this raises the transaction may be aborted, so there's nothing more to do
+            result = original_execute(query, params, *args, **kwargs)
+            elapsed_ms = (time.time() - start) * 1000.0
+            if elapsed_ms >= tracer.threshold_ms:
+                tracer._record(query, params, elapsed_ms, sys._getframe(1))
+            return result
+
+        self._restore = _hook_execute(self._cr, execute)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._restore()
+        self.entries.sort(key=lambda entry: -entry['duration_ms'])
+        if self.entries:
+            _logger.info('SlowQueryTracer: %d of %d statements took %dms or more'
+                % (len(self.entries), self.total_queries, self.threshold_ms))
+        if self.report_path:
+            self.write_report(self.report_path)
+        return False
+
+
+    def _record(self, query, params, elapsed_ms, frame):
+        helper, caller = _call_site(frame)
+        self.entries.append({
+            'duration_ms': round(elapsed_ms, 3),
+            'helper': helper,
+            'caller': caller,
+            'query': _text(query),
+            'params': repr(params),
+            'plan': self._plan(query, params) if self.explain else None,
+        })
+
+
+    def _plan(self, query, params):
+        """Return the plan for a statement that has just run, or a message saying why there isn't one.
+
+        Never raises, so tracing can't change what the traced code sees.
+        """
+        # A separate cursor on the same connection sees the same transaction,
+        # without clobbering the results the caller is about to fetch.
+        connection = getattr(self._cr, '_cnx', None)
+        if connection is None:
+            return None
+        statement = _text(query).lstrip()
+        # WITH might be a data-modifying CTE, so only plain SELECTs are analyzed
+        analyze = self.analyze and statement[:6].upper() == 'SELECT'
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) ' if analyze else 'EXPLAIN '
+        try:
+            explain_cr = connection.cursor()
+            try:
+                explain_cr.execute('SAVEPOINT confutil_explain')
+                try:
+                    explain_cr.execute(prefix + statement, params)
+                    plan = '\n'.join(row[0] for row in explain_cr.fetchall())
+                except Exception as exc:
+                    _logger.debug('SlowQueryTracer: Could not explain %r: %s' % (statement, exc))
+                    plan = 'EXPLAIN failed: %s' % (exc,)
+                # Always undo whatever EXPLAIN ANALYZE did, and any error from EXPLAIN
+                explain_cr.execute('ROLLBACK TO SAVEPOINT confutil_explain')
+                explain_cr.execute('RELEASE SAVEPOINT confutil_explain')
+                return plan
+            finally:
+                explain_cr.close()
+        except Exception as exc:
+            _logger.debug('SlowQueryTracer: Could not explain %r: %s' % (statement, exc))
+            return 'EXPLAIN failed: %s' % (exc,)
+
+
+    def write_report(self, path):
+        """Write the recorded statements to path as JSON.
+        """
+        report = {
+            'threshold_ms': self.threshold_ms,
+            'total_queries': self.total_queries,
+            'slow_queries': self.entries,
+        }
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+def trace_slow_queries(threshold_ms=100, report_path=None, explain=True, analyze=True):
+    """Decorator applying a SlowQueryTracer to a function taking the cursor as its first argument.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(cr, *args, **kwargs):
+            with SlowQueryTracer(cr, threshold_ms=threshold_ms, report_path=report_path,
+                                 explain=explain, analyze=analyze):
+                return func(cr, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _text(query):
+    return query.decode('utf-8') if isinstance(query, bytes) else query
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
@@ -0,0 +1,387 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Check that configuration applied with Config is still in effect, without changing anything.
+
+Declare what you expect with the same arguments you gave to Config, then run:
+
+    verifier = Verifier(registry)
+    for company in companies:
+        verifier.expect_default_taxes(company, 'ST1', 'PT1')
+        verifier.expect_multi_currency(company, '7700', '7710')
+    verifier.expect_user_levels(admin_user, {'Sales': 'Manager'})
+    report = verifier.run()
+    if not report.ok:
+        _logger.error(report.format())
+
+The checks are shared out between a pool of worker threads, each with its own
+read-only transaction.  Defaults, properties and users are each read in bulk;
+settings forms are read through default_get() and never executed.
+"""
+
+from collections import namedtuple
+import sys
+import threading
+import traceback
+
+import logging
+
+from .confutil import Lookup, _plain_id, _plain_value
+
+_logger = logging.getLogger(__name__)
+
+
+Mismatch = namedtuple('Mismatch', ['kind', 'target', 'field', 'expected', 'actual'])
+
+# Model and code field each kind of _Code is looked up by, as in Lookup#tax_ids and Lookup#account_ids
+_CODE_FIELDS = {
+    'tax': ('account.tax', 'description'),
+    'account': ('account.account', 'code'),
+}
+
+
+class VerificationReport(object):
+    """Result of Verifier#run.
+
+    mismatches: List of Mismatch(kind, target, field, expected, actual)
+    errors: List of (check description, formatted traceback) for checks that couldn't be made
+    """
+    def __init__(self, mismatches, errors, checks):
+        self.mismatches = sorted(mismatches, key=lambda m: (m.kind, repr(m.target), m.field))
+        self.errors = errors
+        self.checks = checks
+
+    @property
+    def ok(self):
+        return not (self.mismatches or self.errors)
+
+    def as_dicts(self):
+        return [m._asdict() for m in self.mismatches]
+
+    def format(self):
+        lines = ['%d checks, %d mismatches, %d errors' % (self.checks, len(self.mismatches), len(self.errors))]
+        for m in self.mismatches:
+            lines.append('  %s %s %s: expected %r, found %r' % (m.kind, m.target, m.field, m.expected, m.actual))
+        for (description, error) in self.errors:
+            lines.append('  ERROR %s:\n%s' % (description, error))
+        return '\n'.join(lines)
+
+
+class _Code(object):
+    """Stands in for the id of a company's account or tax until run() resolves it."""
+    def __init__(self, kind, company_id, code):
+        self.kind = kind
+        self.code = code
+        self.key = (company_id, code)
+
+
+class Verifier(object):
+    """Collects expected configuration, then checks it against the database with read-only cursors.
+
+    registry: Registry of the database to check, e.g. the one passed to a post_init_hook.
+              (openerp.registry() would wait forever for the registry lock if called
+              from an installation hook.)
+    uid: User to read as, usually openerp.SUPERUSER_ID
+    workers: Number of read-only connections to spread the checks over
+    """
+    def __init__(self, registry, uid=1, context=None, workers=4):
+        self._registry = registry
+        self._uid = uid
+        self._context = context or {}
+        self._workers = workers
+        self._settings = {}
+        self._defaults = []
+        self._pricelists = []
+        self._user_groups = []
+        self._codes = {}
+
+
+    def expect_settings(self, settings_model_name, changes, company=None):
+        """Expect a settings form to show changes, as passed to Config#set_settings.
+        """
+        key = (settings_model_name, _plain_id(company) if company else None)
+        self._settings.setdefault(key, {}).update(changes)
+        return self
+
+    def expect_account_settings(self, changes, company):
+        return self.expect_settings('account.config.settings', changes, company=company)
+
+    def expect_default_taxes(self, company, sales_code, purchase_code):
+        company_id = _plain_id(company)
+        return self.expect_account_settings({
+            'default_sale_tax': _Code('tax', company_id, sales_code),
+            'default_purchase_tax': _Code('tax', company_id, purchase_code),
+        }, company)
+
+    def expect_multi_currency(self, company, gain_account_code, loss_account_code):
+        company_id = _plain_id(company)
+        return self.expect_account_settings({
+            'group_multi_currency': True,
+            'income_currency_exchange_account_id': _Code('account', company_id, gain_account_code),
+            'expense_currency_exchange_account_id': _Code('account', company_id, loss_account_code),
+        }, company)
+
+    def expect_ordinary_default(self, model, field_name, value, company_id=False):
+        """Expect a global default, as set by Config#set_ordinary_default with for_all_users=True.
+        """
+        self._defaults.append((model, field_name, company_id or False, value))
+        return self
+
+    def expect_customer_sale_pricelist(self, company, pricelist):
+        self._pricelists.append((_plain_id(company), _plain_id(pricelist)))
+        return self
+
+    def expect_user_access_rights(self, user, changes):
+        """Expect group flags as passed to Config#set_user_access_rights.
+        """
+        for (category, group, ticked) in changes:
+            self._user_groups.append((_plain_id(user), category, group, bool(ticked)))
+        return self
+
+    def expect_user_levels(self, user, changes):
+        """Expect application access levels as passed to Config#select_user_levels.
+
+        A level of False means the user has no group in that category.
+        """
+        for (category, group) in changes.items():
+            self._user_groups.append((_plain_id(user), category, group, None))
+        return self
+
+
+    def run(self):
+        """Check everything expected so far.  Return a VerificationReport.
+        """
+        import openerp
+
+        registry = self._registry
+        tasks = []
+        if self._defaults:
+            tasks.append(('defaults', self._check_defaults))
+        if self._pricelists:
+            tasks.append(('customer sale pricelists', self._check_pricelists))
+        if self._user_groups:
+            tasks.append(('user groups', self._check_user_groups))
+        for key in sorted(self._settings, key=repr):
+            tasks.append(('%s for company %s' % key, lambda cr, lookup, key=key: self._check_settings(cr, lookup, key)))
+
+        mismatches = []
+        errors = []
+        lock = threading.Lock()
+
+        with openerp.api.Environment.manage():
+            cr = self._read_only_cursor(registry)
+            try:
+                self._codes = self._resolve_codes(cr, Lookup(cr, registry, self._uid, context=self._context))
+            except Exception:
+                # Without the codes the settings that use them can't be checked
+                self._codes = None
+                errors.append(('account and tax codes', ''.join(traceback.format_exception(*sys.exc_info()))))
+            finally:
+                cr.close()
+
+        def work():
+            with openerp.api.Environment.manage():
+                cr = self._read_only_cursor(registry)
+                lookup = Lookup(cr, registry, self._uid, context=self._context)
+                try:
+                    while True:
+                        with lock:
+                            if not tasks:
+                                return
+                            description, check = tasks.pop()
+                        try:
+                            found = check(cr, lookup)
+                            with lock:
+                                mismatches.extend(found)
+                        except Exception:
+                            with lock:
+                                errors.append((description, ''.join(traceback.format_exception(*sys.exc_info()))))
+                finally:
+                    cr.close()
+
+        checks = len(tasks)
+        threads = [threading.Thread(target=work, name='confutil-verify-%d' % (n,))
+                   for n in range(min(self._workers, len(tasks)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return VerificationReport(mismatches, errors, checks)
+
+
+    def _read_only_cursor(self, registry):
+        cr = registry.cursor()
+        # Closing the cursor without committing rolls this back
+        cr.execute('SET TRANSACTION READ ONLY')
+        return cr
+
+    def _resolve_codes(self, cr, lookup):
+        """Return dictionary mapping (kind, company_id, code) to the list of ids with that code.
+
+        Missing codes are left out.  Missing codes and codes matching more than
+        one record are reported by _check_settings.
+        """
+        wanted = dict((kind, set()) for kind in _CODE_FIELDS)
+        for changes in self._settings.values():
+            for value in changes.values():
+                if isinstance(value, _Code):
+                    wanted[value.kind].add(value.key)
+        codes = {}
+        for (kind, keys) in wanted.items():
+            if not keys:
+                continue
+            model, code_field = _CODE_FIELDS[kind]
+            model_obj = lookup.model(model)
+            ids = model_obj.search(cr, self._uid, [
+                ('company_id', 'in', list(set(company_id for (company_id, _) in keys))),
+                (code_field, 'in', list(set(code for (_, code) in keys))),
+            ], context=self._context.copy())
+            # Not Lookup#index_ids: a code shared by two records is a mismatch to report, not an error
+            for row in model_obj.read(cr, self._uid, ids, ['company_id', code_field], context=self._context.copy()):
+                key = (kind, _plain_value(row['company_id']), row[code_field])
+                if key[1:] in keys:
+                    codes.setdefault(key, []).append(row['id'])
+        return codes
+
+    def _expected(self, value):
+        if isinstance(value, _Code):
+            return self._codes[(value.kind,) + value.key][0]
+        return value
+
+    def _code_problem(self, value):
+        """Return 'missing' or 'ambiguous' if value is a code that doesn't match exactly one record, else None.
+        """
+        if not isinstance(value, _Code):
+            return None
+        if self._codes is None:
+            raise ValueError("Account and tax codes couldn't be resolved, see the error for them")
+        ids = self._codes.get((value.kind,) + value.key, [])
+        if not ids:
+            return 'missing'
+        if len(ids) > 1:
+            return 'ambiguous'
+        return None
+
+
+    def _check_settings(self, cr, lookup, key):
+        settings_model_name, company_id = key
+        target = (settings_model_name, company_id)
+        changes = self._settings[key]
+        # An account or tax code that doesn't match exactly one record can't be set up correctly
+        mismatches = [
+            Mismatch('%s %s' % (self._code_problem(value), value.kind), target, field, value.code,
+                sorted(self._codes.get((value.kind,) + value.key, [])) or None)
+            for (field, value) in sorted(changes.items())
+            if self._code_problem(value)
+        ]
+        changes = dict((field, value) for (field, value) in changes.items() if not self._code_problem(value))
+        settings_model = lookup.model(settings_model_name)
+        context = self._context.copy()
+        actual = settings_model.default_get(cr, self._uid, list(changes), context=context)
+        if company_id and hasattr(settings_model, 'onchange_company_id'):
+            actual.update(settings_model.onchange_company_id(cr, self._uid, [], company_id, context=context).get('value', {}))
+        return mismatches + [
+            Mismatch('settings', target, field, self._expected(value), _plain_value(actual.get(field)))
+            for (field, value) in sorted(changes.items())
+            if not _same(self._expected(value), _plain_value(actual.get(field)))
+        ]
+
+    def _check_defaults(self, cr, lookup):
+        ir_values = lookup.model('ir.values')
+        ids = ir_values.search(cr, self._uid, [
+            ('key', '=', 'default'),
+            ('model', 'in', list(set(model for (model, _, _, _) in self._defaults))),
+            ('user_id', '=', False),
+        ], context=self._context.copy())
+        actual = dict(
+            ((row['model'], row['name'], _plain_value(row['company_id'])), row['value_unpickle'])
+            for row in ir_values.read(cr, self._uid, ids, ['model', 'name', 'company_id', 'value_unpickle'], context=self._context.copy())
+        )
+        mismatches = []
+        for (model, field_name, company_id, value) in self._defaults:
+            found = actual.get((model, field_name, company_id))
+            if not _same(value, found):
+                mismatches.append(Mismatch('default', (model, company_id), field_name, value, found))
+        return mismatches
+
+    def _check_pricelists(self, cr, lookup):
+        field_id = lookup.field_id('res.partner', 'property_product_pricelist')
+        ir_property = lookup.model('ir.property')
+        ids = ir_property.search(cr, self._uid, [
+            ('fields_id', '=', field_id),
+            ('res_id', '=', False),
+            ('company_id', 'in', [company_id for (company_id, _) in self._pricelists]),
+        ], context=self._context.copy())
+        actual = dict(
+            (_plain_value(row['company_id']), row['value_reference'])
+            for row in ir_property.read(cr, self._uid, ids, ['company_id', 'value_reference'], context=self._context.copy())
+        )
+        mismatches = []
+        for (company_id, pricelist_id) in self._pricelists:
+            expected = 'product.pricelist,%d' % (pricelist_id,)
+            if actual.get(company_id) != expected:
+                mismatches.append(Mismatch('property', company_id, 'property_product_pricelist', expected, actual.get(company_id)))
+        return mismatches
+
+    def _check_user_groups(self, cr, lookup):
+        users = lookup.model('res.users')
+        user_ids = list(set(user_id for (user_id, _, _, _) in self._user_groups))
+        groups_of = dict(
+            (row['id'], set(row['groups_id']))
+            for row in users.read(cr, self._uid, user_ids, ['groups_id'], context=self._context.copy())
+        )
+        res_groups = lookup.model('res.groups')
+        group_ids = res_groups.search(cr, self._uid, [
+            ('category_id.name', 'in', list(set(category for (_, category, _, _) in self._user_groups))),
+        ], context=self._context.copy())
+        groups = res_groups.read(cr, self._uid, group_ids, ['category_id', 'name'], context=self._context.copy())
+        in_category = {}
+        group_id = {}
+        for row in groups:
+            category = row['category_id'][1] if row['category_id'] else False
+            in_category.setdefault(category, set()).add(row['id'])
+            group_id[(category, row['name'])] = row['id']
+
+        mismatches = []
+        for (user_id, category, group, ticked) in self._user_groups:
+            target = ('res.users', user_id)
+            if ticked is None:
+                # Application level: exactly the one group (or none) from the category
+                held = groups_of[user_id] & in_category.get(category, set())
+                expected = set([group_id.get((category, group))]) if group else set()
+                if not expected <= held or (not group and held):
+                    mismatches.append(Mismatch('user level', target, category, group, sorted(held)))
+            else:
+                has_group = group_id.get((category, group)) in groups_of[user_id]
+                if has_group != ticked:
+                    mismatches.append(Mismatch('user group', target, '%s / %s' % (category, group), ticked, has_group))
+        return mismatches
+
+
+def _same(expected, actual):
+    if isinstance(expected, (list, tuple, set)) and isinstance(actual, (list, tuple, set)):
+        return set(expected) == set(actual)
+    if expected is False or expected is None:
+        return not actual
+    return expected == actual
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
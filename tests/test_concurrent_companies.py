@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""Advisory lock keys and resources; runs without Odoo.
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from confutil.concurrent_companies import GLOBAL_RESOURCE, advisory_lock, lock_key, settings_resources
+
+
+class FakeCompany(object):
+    def __init__(self, id):
+        self.id = id
+
+
+class FakeCursor(object):
+    def __init__(self):
+        self.params = []
+
+    def execute(self, query, params=None):
+        self.params.append(params)
+
+
+class TestLocks(unittest.TestCase):
+
+    def test_lock_key_is_stable_signed_64_bit(self):
+        key = lock_key(('settings', 'account.config.settings', 1))
+        self.assertEqual(key, lock_key(('settings', u'account.config.settings', 1)))
+        self.assertTrue(-2 ** 63 <= key < 2 ** 63)
+        self.assertNotEqual(key, lock_key(('settings', 'account.config.settings', 2)))
+
+    def test_advisory_lock_sorted_and_unique(self):
+        cr = FakeCursor()
+        resources = [('b',), ('a',), ('b',)]
+        advisory_lock(cr, resources)
+        self.assertEqual([params[0] for params in cr.params], sorted(set(lock_key(r) for r in resources)))
+
+    def test_settings_resources(self):
+        self.assertEqual(settings_resources('base.config.settings', {'group_light_multi_company': True}),
+            [GLOBAL_RESOURCE])
+        self.assertEqual(settings_resources('sale.config.settings', {'group_discount_per_so_line': True}, FakeCompany(3)),
+            [('settings', 'sale.config.settings', 3)])
+        with self.assertRaises(ValueError):
+            settings_resources('sale.config.settings', {'module_sale_margin': True}, FakeCompany(3))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
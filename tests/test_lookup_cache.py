@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""LookupCache round trip, invalidation and validation; runs without Odoo.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from confutil.lookup_cache import LookupCache
+
+
+class FakeCursor(object):
+    """Answers the validation queries from a fixed set of rows."""
+    def __init__(self, xmlids=(), ids=()):
+        self.xmlids = list(xmlids)
+        self.ids = set(ids)
+        self.statements = []
+        self._rows = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        if 'ir_model_data' in query:
+            wanted = set(params[0])
+            self._rows = [row for row in self.xmlids if (row[0], row[1]) in wanted]
+        else:
+            self._rows = [(i,) for i in params[0] if i in self.ids]
+
+    def fetchall(self):
+        return self._rows
+
+
+class TestLookupCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'lookup.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make(self, signature='sig', database_uuid='uuid'):
+        return LookupCache(self.path, 'db', signature, database_uuid=database_uuid)
+
+    def test_round_trip(self):
+        cache = self.make()
+        cache.set('xmlid:base.main_company', 'res.company,1')
+        cache.set('field:res.partner.name', 42)
+        cache.save()
+        loaded = self.make()
+        self.assertEqual(loaded.get('xmlid:base.main_company'), 'res.company,1')
+        self.assertEqual(loaded.get('field:res.partner.name'), 42)
+
+    def test_discarded_when_signature_changes(self):
+        cache = self.make()
+        cache.set('field:res.partner.name', 42)
+        cache.save()
+        self.assertEqual(len(self.make(signature='other')), 0)
+        self.assertEqual(len(self.make(database_uuid='other')), 0)
+
+    def test_ignored_when_writable_by_others(self):
+        cache = self.make()
+        cache.set('field:res.partner.name', 42)
+        cache.save()
+        os.chmod(self.path, 0o666)
+        self.assertEqual(len(self.make()), 0)
+
+    def test_validate_drops_stale_entries(self):
+        cache = self.make()
+        cache.set('xmlid:base.main_company', 'res.company,1')
+        cache.set('xmlid:my_module.rolled_back', 'res.partner,99')
+        cache.set('field:res.partner.name', 42)
+        cache.set('field:res.partner.gone', 43)
+        cache.set('group:Sales/Manager', 7)
+        cr = FakeCursor(xmlids=[('base', 'main_company', 'res.company', 1)], ids=[42, 7])
+        self.assertEqual(cache.validate(cr), 2)
+        self.assertEqual(len(cr.statements), 3)
+        self.assertEqual(cache.get('xmlid:base.main_company'), 'res.company,1')
+        self.assertIsNone(cache.get('xmlid:my_module.rolled_back'))
+        self.assertIsNone(cache.get('field:res.partner.gone'))
+        self.assertEqual(cache.get('group:Sales/Manager'), 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4:
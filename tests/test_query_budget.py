@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+##############################################################################
+#
+# Post-installation configuration helpers
+# Copyright (C) 2014 OpusVL (<http://opusvl.com/>)
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as
+# published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+#
+##############################################################################
+
+"""QueryBudget against a stand-in cursor; runs without Odoo.
+
+    python -m unittest discover -s tests
+"""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from confutil.query_budget import QueryBudget, QueryBudgetExceeded, query_budget
+
+
+class FakeCursor(object):
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+
+
+def run_queries(cr, count):
+    for n in range(count):
+        cr.execute('SELECT %s', (n,))
+
+
+class TestQueryBudget(unittest.TestCase):
+
+    def test_counts_statements(self):
+        cr = FakeCursor()
+        with QueryBudget(cr, max_queries=3) as budget:
+            run_queries(cr, 3)
+        self.assertEqual(budget.queries, 3)
+        self.assertEqual(len(cr.statements), 3)
+
+    def test_raises_when_over_budget(self):
+        cr = FakeCursor()
+        with self.assertRaises(QueryBudgetExceeded):
+            with QueryBudget(cr, max_queries=2):
+                run_queries(cr, 3)
+
+    def test_log_only_does_not_raise(self):
+        cr = FakeCursor()
+        with QueryBudget(cr, max_queries=2, log_only=True) as budget:
+            run_queries(cr, 3)
+        self.assertEqual(budget.queries, 3)
+
+    def test_execute_restored_after_block(self):
+        cr = FakeCursor()
+        with QueryBudget(cr):
+            self.assertIn('execute', cr.__dict__)
+        self.assertNotIn('execute', cr.__dict__)
+
+    def test_counters_reset_per_block(self):
+        cr = FakeCursor()
+        budget = QueryBudget(cr, max_queries=2)
+        with budget:
+            run_queries(cr, 2)
+        with budget:
+            run_queries(cr, 1)
+        self.assertEqual(budget.queries, 1)
+        self.assertEqual(sum(queries for (_, _, queries, _) in budget.breakdown()), 1)
+
+    def test_instance_as_decorator_called_repeatedly(self):
+        cr = FakeCursor()
+        hook = QueryBudget(cr, max_queries=2)(lambda: run_queries(cr, 2))
+        for _ in range(3):
+            hook()
+        self.assertEqual(len(cr.statements), 6)
+
+    def test_query_budget_decorator(self):
+        @query_budget(max_queries=1)
+        def hook(cr):
+            run_queries(cr, 2)
+        with self.assertRaises(QueryBudgetExceeded):
+            hook(FakeCursor())
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# vim:expandtab:smartindent:tabstop=4:softtabstop=4:shiftwidth=4: